@@ -0,0 +1,248 @@
+from pileup_reader import build_pileup_index, pileup_region_reader, count_pileup_samples
+from indel_table import IndelTable
+from vcf_writer import FAI_PATH, create_vcf_header, create_vcf_record, default_sample_names
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import argparse
+import os
+import threading
+
+class CallingService(object):
+    """ Keeps everything that does not depend on the called region warm
+    between requests: VCF headers built from the .fai file, pileup indexes
+    and the variant caller with its genotype caches.
+    """
+
+    def __init__(self, fai_path=FAI_PATH, index_step=1000, data_dir='.'):
+        # numpy comes with the variant caller, see main.py
+        from variant_caller import VariantCaller
+        self.variant_caller = VariantCaller()
+        self.fai_path = fai_path
+        self.index_step = index_step
+        self.data_dir = os.path.realpath(data_dir)
+        self.headers = {}
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def get_header(self, sample_count=1, genotype_likelihoods=False):
+        """ Returns cached VCF header, creating it on first use
+
+        Parameters
+        ----------
+        sample_count: int
+            Number of samples in the header
+        genotype_likelihoods: bool
+            Whether the header declares GL and PL format fields
+
+        Returns
+        -------
+        pysam.VariantHeader
+            VCF header
+        """
+        key = (sample_count, genotype_likelihoods)
+        with self.lock:
+            if key not in self.headers:
+                self.headers[key] = create_vcf_header(default_sample_names(sample_count), genotype_likelihoods,
+                                                      self.fai_path)
+            return self.headers[key]
+
+    def resolve_input(self, path):
+        """ Resolves path of a pileup file against the data directory,
+        refusing paths outside of it
+
+        Parameters
+        ----------
+        path: str
+            Path to the pileup file, relative to the data directory
+
+        Returns
+        -------
+        str
+            Absolute path to the pileup file
+        """
+        resolved = os.path.realpath(os.path.join(self.data_dir, path))
+        if os.path.commonpath([resolved, self.data_dir]) != self.data_dir:
+            raise PermissionError('{} is outside of the data directory'.format(path))
+        return resolved
+
+    def get_index(self, path):
+        """ Returns cached index of a pileup file, rebuilding it if the file
+        changed since it was indexed
+
+        Parameters
+        ----------
+        path: str
+            Absolute path to the pileup file
+
+        Returns
+        -------
+        (dict, int)
+            Index of the pileup file, as built by build_pileup_index, and
+            number of samples in it
+        """
+        modified = os.path.getmtime(path)
+        with self.lock:
+            if path in self.indexes and self.indexes[path][0] == modified:
+                return self.indexes[path][1:]
+        index = build_pileup_index(path, self.index_step)
+        sample_count = count_pileup_samples(path)
+        with self.lock:
+            self.indexes[path] = (modified, index, sample_count)
+        return index, sample_count
+
+    def call_region(self, path, region, correct_probability=0.99, use_read_quality=False,
+                    genotype_likelihoods=False, batch_size=10000):
+        """ Calls variants in one region of a pileup file
+
+        Parameters
+        ----------
+        path: str
+            Path to the pileup file, relative to the data directory
+        region: str
+            Region to call, as chromosome, chromosome:start or chromosome:start-end
+        correct_probability: float
+            Probability that one nucleotide in a read is correct
+        use_read_quality: bool
+            Whether to use correct_probability estimate calculated using read qualities
+        genotype_likelihoods: bool
+            Whether to write GL and PL fields
+        batch_size: int
+            How many positions to call at once
+
+        Returns
+        -------
+        str
+            VCF records of the region, without header
+        """
+        chromosome, start, end = parse_region(region)
+        path = self.resolve_input(path)
+        index, sample_count = self.get_index(path)
+        header = self.get_header(sample_count, genotype_likelihoods)
+        sample = default_sample_names(sample_count)
+
+        # Every request interns its indels into its own table, so the service does not grow with them
+        indel_table = IndelTable()
+        lines = []
+        batch = []
+        for pileup_line in pileup_region_reader(path, index, chromosome, start, end, indel_table):
+            batch.append(pileup_line)
+            if len(batch) >= batch_size:
+                lines += self.__call_batch__(batch, header, sample, correct_probability, use_read_quality,
+                                             genotype_likelihoods, indel_table)
+                batch = []
+        lines += self.__call_batch__(batch, header, sample, correct_probability, use_read_quality,
+                                     genotype_likelihoods, indel_table)
+        return ''.join(lines)
+
+    def __call_batch__(self, batch, header, sample, correct_probability, use_read_quality, genotype_likelihoods,
+                       indel_table):
+        self.variant_caller.call_variants(batch, correct_probability, use_read_quality, genotype_likelihoods,
+                                          indel_table)
+        return [str(create_vcf_record(pileup_line, header, sample)) for pileup_line in batch]
+
+def parse_region(region):
+    """ Parses region given as chromosome, chromosome:start or chromosome:start-end,
+    with 1-based inclusive positions
+
+    Parameters
+    ----------
+    region: str
+        Region to parse
+
+    Returns
+    -------
+    (str, int, int)
+        Chromosome, first and last position of the region, None if not given
+    """
+    chromosome, _, interval = region.partition(':')
+    if not interval:
+        return chromosome, None, None
+    start, _, end = interval.replace(',', '').partition('-')
+    return chromosome, int(start), int(end) if end else None
+
+def create_handler(service):
+    """ Creates HTTP request handler class bound to a calling service. Serves
+
+        GET /header?samples=2&genotype_likelihoods=1
+        GET /call?input=PILEUP&region=21:9483252-9483266&p=0.99&genotype_likelihoods=1
+
+    with PILEUP relative to the data directory of the service.
+
+    Parameters
+    ----------
+    service: CallingService
+        Service to call variants with
+
+    Returns
+    -------
+    type
+        Request handler class
+    """
+
+    class CallingRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            genotype_likelihoods = query.get('genotype_likelihoods', '0') in ('1', 'true')
+            try:
+                if url.path == '/header':
+                    body = str(service.get_header(int(query.get('samples', 1)), genotype_likelihoods))
+                elif url.path == '/call':
+                    body = service.call_region(query['input'], query['region'],
+                                               float(query.get('p', 0.99)),
+                                               query.get('use_read_quality', '0') in ('1', 'true'),
+                                               genotype_likelihoods,
+                                               int(query.get('batch_size', 10000)))
+                else:
+                    self.send_error(404)
+                    return
+            except PermissionError as error:
+                self.send_error(403, explain=str(error))
+                return
+            except (KeyError, ValueError, OSError) as error:
+                self.send_error(400, explain=repr(error))
+                return
+            except Exception as error:
+                # Whatever else fails in one request is reported to its client, not only logged here
+                self.log_error('Request %r failed: %r', self.path, error)
+                self.send_error(500, explain=repr(error))
+                return
+
+            body = body.encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return CallingRequestHandler
+
+def main():
+    """ Parses command line arguments and serves region calling requests on
+    localhost until interrupted
+    """
+
+    parser = argparse.ArgumentParser(description='Runs variant calling as a long-lived local HTTP service')
+    parser.add_argument('--host', default='127.0.0.1', type=str,
+                        help='address to listen on')
+    parser.add_argument('--port', default='8765', type=int,
+                        help='port to listen on')
+    parser.add_argument('--fai-file', default=FAI_PATH, type=str,
+                        help='path to .fai index of the reference genome, used for the vcf header')
+    parser.add_argument('--index-step', default='1000', type=int,
+                        help='how many pileup lines to skip between two indexed lines')
+    parser.add_argument('--data-dir', default='.', type=str,
+                        help='directory with the pileup files, inputs outside of it are refused')
+    args = parser.parse_args()
+
+    service = CallingService(fai_path=args.fai_file, index_step=args.index_step, data_dir=args.data_dir)
+    server = ThreadingHTTPServer((args.host, args.port), create_handler(service))
+    print('Serving on http://{}:{}'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == '__main__':
+    main()
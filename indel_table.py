@@ -0,0 +1,99 @@
+import threading
+
+class IndelTable(object):
+    """ Interns indel alleles: every distinct (indel string, variant type)
+    pair gets one integer id, and its string is stored only once, however
+    many positions and reads it appears at. Ids are only meaningful within
+    one table, so records must be called with the table they were read with.
+    """
+
+    def __init__(self):
+        # (indel string, variant type) of each id, in the same shape the variant caller uses for alleles
+        self.alleles = []
+        self.ids = {}
+        # Raw pileup indel tokens, like .+3CGC, already parsed to an id
+        self.token_ids = {}
+        self.lock = threading.RLock()
+
+    def intern(self, indel_type, indel_string):
+        """ Returns id of an indel allele, adding it to the table if it is new
+
+        Parameters
+        ----------
+        indel_type: str
+            INS or DEL
+        indel_string: str
+            Inserted or deleted bases
+
+        Returns
+        -------
+        int
+            Id of the indel allele
+        """
+        allele = (indel_string, indel_type)
+        indel_id = self.ids.get(allele)
+        if indel_id is None:
+            with self.lock:
+                indel_id = self.ids.get(allele)
+                if indel_id is None:
+                    indel_id = len(self.alleles)
+                    self.alleles.append(allele)
+                    self.ids[allele] = indel_id
+        return indel_id
+
+    def intern_token(self, token, get_indel_string):
+        """ Returns id of the indel allele of a raw pileup token, parsing the
+        token only the first time it is seen
+
+        Parameters
+        ----------
+        token: str
+            Raw pileup indel token, like .+3CGC or .-1A
+        get_indel_string: function
+            Parses a token to its inserted or deleted bases
+
+        Returns
+        -------
+        int
+            Id of the indel allele
+        """
+        indel_id = self.token_ids.get(token)
+        if indel_id is None:
+            with self.lock:
+                indel_id = self.token_ids.get(token)
+                if indel_id is None:
+                    indel_type = 'INS' if token[1] == '+' else 'DEL'
+                    indel_id = self.intern(indel_type, get_indel_string(token))
+                    self.token_ids[token] = indel_id
+        return indel_id
+
+    def clear(self):
+        """ Forgets every interned allele and token, invalidating all ids
+        given out so far
+        """
+        with self.lock:
+            self.alleles = []
+            self.ids = {}
+            self.token_ids = {}
+
+    def allele(self, indel_id):
+        """ Returns (indel string, variant type) of an id
+
+        Parameters
+        ----------
+        indel_id: int
+            Id of the indel allele
+
+        Returns
+        -------
+        (str, str)
+            Inserted or deleted bases and INS or DEL
+        """
+        return self.alleles[indel_id]
+
+    def __len__(self):
+        return len(self.alleles)
+
+# Default table of callers that do not pass their own; it is never cleared, so
+# long-running callers should use a table per run or batch instead
+INDEL_TABLE = IndelTable()
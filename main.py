@@ -1,6 +1,7 @@
-from pileup_reader import pileup_reader
-from variant_caller import VariantCaller
-from vcf_writer import create_vcf_file, write_vcf_line
+from pileup_reader import pileup_reader, count_pileup_samples
+from vcf_writer import create_vcf_file, write_vcf_line, default_sample_names
+from telemetry import MemoryBudget, TelemetryLogger
+from indel_table import IndelTable
 import time
 import argparse
 
@@ -24,41 +25,98 @@ def main():
                         help='probability estimate of one nucleotide read being correct, used by vc algorithm')
     parser.add_argument('--positions-to-call', default='10000', type=int,
                         help='how many positions to call if call-less-positions set to true')
+    parser.add_argument('--batch-size', default='10000', type=int,
+                        help='how many positions to call at once')
+    parser.add_argument('--genotype-likelihoods', default=False, action='store_true',
+                        help='tells the program to write GL and PL fields to the vcf file')
+    parser.add_argument('--sample-names', default=None, type=str,
+                        help='comma separated names of samples in the pileup file. If not given, will be SAMPLE1, SAMPLE2, ...')
+    parser.add_argument('--memory-budget', default=None, type=float,
+                        help='target resident memory in MB, batch size is adapted to stay under it')
+    parser.add_argument('--telemetry-file', default=None, type=str,
+                        help='path to a JSON lines log of memory use, throughput and queue depth')
+    parser.add_argument('--telemetry-interval', default='10', type=float,
+                        help='seconds between two telemetry records')
     args = parser.parse_args()
+    if args.batch_size < 1:
+        parser.error('--batch-size must be at least 1')
     if args.output_file == 'Make name from input name':
         args.output_file = args.input_file + '.vcf'
     
+    # numpy comes with the variant caller, so it is only imported once the
+    # arguments are parsed and there is something to call
+    from variant_caller import VariantCaller
     variant_caller = VariantCaller()
-    sample = 'SAMPLE1'
+    try:
+        sample_count = count_pileup_samples(args.input_file)
+    except ValueError as error:
+        parser.error(str(error))
+    if args.sample_names is None:
+        sample = default_sample_names(sample_count)
+    else:
+        sample = args.sample_names.split(',')
+        if len(sample) != sample_count:
+            parser.error('--sample-names has {} names, but {} has {} samples'.format(
+                len(sample), args.input_file, sample_count))
+        if len(sample) == 1:
+            sample = sample[0]
     
     # creates vcf file
     create_vcf_start = time.time()
-    vcf = create_vcf_file(args.output_file, sample)
+    vcf = create_vcf_file(args.output_file, sample, args.genotype_likelihoods)
     create_vcf_end = time.time()
     print('Vcf header created. Elapsed time: {}'.format(create_vcf_end - create_vcf_start))
 
+    # indels of the run are interned per batch, so the table is cleared once a batch is written
+    indel_table = IndelTable()
+
     main_loop_start = time.time()
     position_count = 0
     variant_caller_time = 0
     positions_with_variants = 0
     write_vcf_time = 0
 
-    for pileup_line in pileup_reader(args.input_file):
-        # calls variant for each pileup line
+    def call_and_write(batch):
+        nonlocal variant_caller_time, positions_with_variants, write_vcf_time
+        # calls variants for a whole batch of pileup lines at once
         variant_caller_start = time.time()
-        variant_caller.call_variant(pileup_line, args.p, args.use_read_quality)
-        if pileup_line['alts'] != '.':
-            positions_with_variants += 1
+        variant_caller.call_variants(batch, args.p, args.use_read_quality, args.genotype_likelihoods,
+                                     indel_table)
+        positions_with_variants += sum(1 for pileup_line in batch
+                                       if any(sample_line['alts'] != '.'
+                                              for sample_line in pileup_line.get('samples', [pileup_line])))
         variant_caller_time += time.time() - variant_caller_start
 
-        # writes line in VCF file
+        # writes lines in VCF file
         write_vcf_start = time.time()
-        write_vcf_line(pileup_line, vcf, sample)
-        write_vcf_time = time.time() - write_vcf_start
+        for pileup_line in batch:
+            write_vcf_line(pileup_line, vcf, sample)
+        write_vcf_time += time.time() - write_vcf_start
+        indel_table.clear()
+
+    memory_budget = MemoryBudget(args.memory_budget * 1024 * 1024 if args.memory_budget is not None else None,
+                                 args.batch_size)
+    telemetry = TelemetryLogger(args.telemetry_file, args.telemetry_interval)
 
+    batch = []
+    for pileup_line in pileup_reader(args.input_file, indel_table):
+        batch.append(pileup_line)
         position_count += 1
+        # checks memory and logs telemetry every min_batch_size lines, in case a batch grows over
+        # budget before it is full
+        checkpoint = len(batch) % memory_budget.min_batch_size == 0
+        if checkpoint:
+            telemetry.update(position_count, len(batch), memory_budget.batch_size)
+        if len(batch) >= memory_budget.batch_size or (checkpoint and memory_budget.over_budget()):
+            memory_budget.adapt()
+            call_and_write(batch)
+            batch = []
         if args.call_less_positions and (position_count >= args.positions_to_call):
             break
+    call_and_write(batch)
+    vcf.close()
+    telemetry.update(position_count, 0, memory_budget.batch_size, force=True)
+    telemetry.close()
     
     main_loop_end = time.time()
     total_running_time = main_loop_end - main_loop_start
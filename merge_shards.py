@@ -0,0 +1,25 @@
+from vcf_writer import FAI_PATH, merge_vcf_shards
+import time
+import argparse
+
+def main():
+    """ Parses command line arguments and merges VCF shards into one BGZF
+    compressed, tabix indexed VCF file
+    """
+
+    parser = argparse.ArgumentParser(description='Merges position sorted vcf shards into one bgzipped and indexed vcf file')
+    parser.add_argument('shards', nargs='+', type=str,
+                        help='paths to vcf shards, plain or compressed')
+    parser.add_argument('--output-file', required=True, type=str,
+                        help='path to the merged vcf file, for example out.vcf.gz. Index is written to out.vcf.gz.tbi')
+    parser.add_argument('--fai-file', default=FAI_PATH, type=str,
+                        help='path to .fai index of the reference genome, gives the contig order')
+    args = parser.parse_args()
+
+    merge_start = time.time()
+    record_count = merge_vcf_shards(args.shards, args.output_file, args.fai_file)
+    print('Merged {} records from {} shards. Elapsed time: {}'.format(record_count, len(args.shards),
+                                                                       time.time() - merge_start))
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,7 @@
 import numpy as np
-import pysam
-import matplotlib.pyplot as plt
-import pandas as pd
-import seaborn as sn
+
+# pysam and the plotting libraries are imported where they are used, so
+# that the counting functions can be imported without paying for them
 
 
 def precision(tp, fp, fn):
@@ -46,6 +45,8 @@ def get_statistics(bfctools_vcf_file, vcf_file):
         true negatives
     """    
     
+    import pysam
+    
     bcftools_vcf = pysam.VariantFile(bcftools_vcf_file, "r")
     vcf = pysam.VariantFile(vcf_file, "r")
         
@@ -78,101 +79,188 @@ def get_statistics(bfctools_vcf_file, vcf_file):
     vcf.close()
     return tp, fp, fn, tn
     
-def metrics(bcftools_vcf_file, vcf_files):
-    """ Prints precision, recall, F1 score, accuracy, MCC score and 
-    confusion matrix for each VCF file. Plots precision, recall, F1 score,
-    accuracy and MCC score against probabilities. 
+def get_scored_records(bcftools_vcf_file, vcf_file, score_field='VAF', sample=None):
+    """ Reads score, call and truth label of every record in our VCF file,
+    matching it against bfctools VCF file only once. Records are labeled as
+    true if bfctools called a variant at the same position.
     
     Parameters
     ----------
     bfctools_vcf_file: str
         path to VCF file created by bfctools call tool
-    vcf_files: list of str
-        paths to VCF files created by our algorithm with different 
-        probabilities
+    vcf_file: str
+        path to VCF file created by our algorithm
+    score_field: str
+        name of the sample format field holding the score of a call
+    sample: str
+        name of the sample to score in our VCF file, the first one in its
+        header if not given
         
-    """  
+    Returns
+    -------
+    (np.ndarray, np.ndarray, np.ndarray)
+        Score of each record, whether we called a variant there and whether
+        bfctools called a variant there
+    """
     
-    p = []
-    
-    for vcf_file in vcf_files:
-        info = vcf_file.split('.')
-        p.append(float(info[2]) / 100)
-    
-    TP = []
-    FP = []
-    FN = []
-    TN = []
-    precision_list = []
-    recall_list = []
-    f1_score_list = []
-    accuracy_list = []
-    mcc_list = []
-    predicted_variants = []
-    true_variants = []
-    
-    for vcf_file in vcf_files:
-        tp, fp, fn, tn = get_statistics(bcftools_vcf_file, vcf_file)
-        TP.append(tp)
-        FP.append(fp)
-        FN.append(fn)
-        TN.append(tn)
-        predicted_variants.append(tp + fp)
-        true_variants.append(tp + fn)
-        precision_list.append(precision(tp, fp, fn))
-        recall_list.append(recall(tp, fp, fn))
-        f1_score_list.append(f1_score(tp, fp, fn))
-        accuracy_list.append(accuracy(tp, fp, fn, tn))
-        mcc_list.append(mcc(tp, fp, fn, tn))
-       
-    for i in range(len(vcf_files)):
-        print('Probability: {}'.format(p[i]))
-        print('Precision: {}'.format(precision_list[i]))
-        print('Recall: {}'.format(recall_list[i]))
-        print('F1 score: {}'.format(f1_score_list[i]))
-        print('Accuracy: {}'.format(accuracy_list[i]))
-        print('MCC score: {}'.format(mcc_list[i]))
-        print('')
+    import pysam
+    
+    bcftools_vcf = pysam.VariantFile(bcftools_vcf_file, "r")
+    vcf = pysam.VariantFile(vcf_file, "r")
+    if sample is None:
+        sample = vcf.header.samples[0]
+    
+    data_bcftools = set()
+    for record in bcftools_vcf.fetch():
+        if record.samples['HCC1143BL']['GT'] != (0, 0):
+            data_bcftools.add((record.chrom, record.pos))
+    
+    scores = []
+    called = []
+    true = []
+    for record in vcf.fetch():
+        score = record.samples[sample][score_field]
+        scores.append(float(score) if score is not None else 0.0)
+        called.append(record.samples[sample]['GT'] != (0, 0))
+        true.append((record.chrom, record.pos) in data_bcftools)
+    
+    bcftools_vcf.close()
+    vcf.close()
+    return np.array(scores), np.array(called, dtype=bool), np.array(true, dtype=bool)
+
+def get_curve(scores, called, true):
+    """ Calculates the number of true positives, false positives, false
+    negatives and true negatives at every score threshold at once. At a
+    threshold t, a record is predicted as variant if we called a variant
+    there with score >= t.
+    
+    Parameters
+    ----------
+    scores: np.ndarray
+        Score of each record
+    called: np.ndarray
+        Whether we called a variant at each record
+    true: np.ndarray
+        Whether bfctools called a variant at each record
         
-        confusion_matrix = np.array([[TN[i], FP[i]],[FN[i], TP[i]]])
-        df_cm = pd.DataFrame(confusion_matrix, range(2), range(2))
-        plt.figure(i)
-        sn.set(font_scale=1.4)
-        ax = sn.heatmap(df_cm, annot=True, annot_kws={"size": 16}, fmt="d", cmap="YlGnBu")
+    Returns
+    -------
+    (np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray)
+        Thresholds in decreasing order and number of true positives, false
+        positives, false negatives and true negatives at each of them. If
+        no variant is called, a single point at infinite threshold where
+        every record is predicted negative
+    """
+    
+    positives = np.count_nonzero(true)
+    if not np.any(called):
+        return np.array([np.inf]), np.array([0]), np.array([0]), np.array([positives]), \
+            np.array([len(true) - positives])
+    
+    order = np.argsort(-scores[called], kind='stable')
+    called_scores = scores[called][order]
+    called_true = true[called][order]
+    
+    tp = np.cumsum(called_true)
+    fp = np.cumsum(~called_true)
+    
+    # Records with equal scores pass the same thresholds
+    last = np.append(called_scores[1:] != called_scores[:-1], True)
+    thresholds = called_scores[last]
+    tp = tp[last]
+    fp = fp[last]
+    
+    fn = positives - tp
+    tn = len(true) - positives - fp
+    return thresholds, tp, fp, fn, tn
+
+def metrics(bcftools_vcf_file, vcf_file, score_field='VAF', sample=None):
+    """ Prints precision, recall, F1 score, accuracy, MCC score and 
+    confusion matrix at the score threshold with the best F1 score. Plots
+    precision, recall, F1 score, accuracy and MCC score against every score
+    threshold, and the precision/recall curve. 
+    
+    Parameters
+    ----------
+    bfctools_vcf_file: str
+        path to VCF file created by bfctools call tool
+    vcf_file: str
+        path to VCF file created by our algorithm
+    score_field: str
+        name of the sample format field holding the score of a call
+    sample: str
+        name of the sample to score in our VCF file, the first one in its
+        header if not given
         
-        ax.set(xlabel='Predicted', ylabel='True')
+    """  
+    
+    import matplotlib.pyplot as plt
+    import pandas as pd
+    import seaborn as sn
+    
+    scores, called, true = get_scored_records(bcftools_vcf_file, vcf_file, score_field, sample)
+    thresholds, tp, fp, fn, tn = get_curve(scores, called, true)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision_list = precision(tp, fp, fn)
+        recall_list = recall(tp, fp, fn)
+        f1_score_list = f1_score(tp, fp, fn)
+        accuracy_list = accuracy(tp, fp, fn, tn)
+        mcc_list = mcc(tp, fp, fn, tn)
+    predicted_variants = tp + fp
+    true_variants = tp + fn
+    
+    # F1 score is undefined while nothing is predicted as variant
+    i = np.nanargmax(f1_score_list) if not np.all(np.isnan(f1_score_list)) else 0
+    print('Threshold: {}'.format(thresholds[i]))
+    print('Precision: {}'.format(precision_list[i]))
+    print('Recall: {}'.format(recall_list[i]))
+    print('F1 score: {}'.format(f1_score_list[i]))
+    print('Accuracy: {}'.format(accuracy_list[i]))
+    print('MCC score: {}'.format(mcc_list[i]))
+    print('')
+    
+    confusion_matrix = np.array([[tn[i], fp[i]],[fn[i], tp[i]]])
+    df_cm = pd.DataFrame(confusion_matrix, range(2), range(2))
+    plt.figure('Confusion matrix')
+    sn.set(font_scale=1.4)
+    ax = sn.heatmap(df_cm, annot=True, annot_kws={"size": 16}, fmt="d", cmap="YlGnBu")
+    
+    ax.set(xlabel='Predicted', ylabel='True')
 
-        plt.show() 
+    plt.show() 
     
     plt.figure('Metrics')
     plt.title('Metrics')
-    plt.xlabel('Probability')
+    plt.xlabel('Threshold')
     plt.ylabel('Metrics')
-    plt.plot(p, precision_list, label = 'Precision')
-    plt.plot(p, recall_list, label = 'Recall')
-    plt.plot(p, f1_score_list, label = 'F1 score')
-    plt.plot(p, accuracy_list, label = 'Accuracy')
-    plt.plot(p, mcc_list, label = 'MCC score')
+    plt.plot(thresholds, precision_list, label = 'Precision')
+    plt.plot(thresholds, recall_list, label = 'Recall')
+    plt.plot(thresholds, f1_score_list, label = 'F1 score')
+    plt.plot(thresholds, accuracy_list, label = 'Accuracy')
+    plt.plot(thresholds, mcc_list, label = 'MCC score')
     plt.legend(loc = 'lower left')
     plt.show()
     
+    plt.figure('Precision/Recall')
+    plt.title('Precision/Recall')
+    plt.xlabel('Recall')
+    plt.ylabel('Precision')
+    plt.plot(recall_list, precision_list)
+    plt.show()
+    
     plt.figure('Variants')
     plt.title('Variants')
-    plt.xlabel('Probability')
+    plt.xlabel('Threshold')
     plt.ylabel('Number of variants')
-    plt.plot(p, predicted_variants, label = 'Predicted variants')
-    plt.plot(p, true_variants, label = 'True variants')
+    plt.plot(thresholds, predicted_variants, label = 'Predicted variants')
+    plt.plot(thresholds, true_variants, label = 'True variants')
     plt.legend(loc = 'lower right')
     plt.show()
     
 if __name__ == '__main__':
     bcftools_vcf_file = "merged-normal.bam.mpileup.vcf.called.vcf"
-    vcf_files = ["merged-normal.pileup.50.vcf", "merged-normal.pileup.55.vcf",
-                 "merged-normal.pileup.60.vcf", "merged-normal.pileup.65.vcf",
-                 "merged-normal.pileup.70.vcf", "merged-normal.pileup.75.vcf",
-                 "merged-normal.pileup.80.vcf", "merged-normal.pileup.85.vcf",
-                 "merged-normal.pileup.90.vcf", "merged-normal.pileup.95.vcf",
-                 "merged-normal.pileup.100.vcf"]
-    
-    metrics(bcftools_vcf_file, vcf_files)
+    vcf_file = "merged-normal.pileup.vcf"
+    
+    metrics(bcftools_vcf_file, vcf_file)
     
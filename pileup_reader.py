@@ -1,6 +1,7 @@
-import numpy as np
+import bisect
 import re
 from collections import Counter
+from indel_table import INDEL_TABLE
 
 def preprocess_bases(read_bases):
     """ Returns read without irrelevant characters
@@ -99,7 +100,175 @@ def get_indel_string(read_bases):
     return indel_string
 
 
-def pileup_reader(path):
+def count_indels(indel_tokens, indel_table=INDEL_TABLE):
+    """ Counts indels by their id in the interned indel table. Each distinct
+    raw token is parsed with get_indel_string only the first time it is seen.
+    
+    Parameters
+    ----------
+    indel_tokens: list of str
+        Raw indel tokens of one position, like .+3CGC or .-1A
+    indel_table: IndelTable
+        Table to intern indels into
+        
+    Returns
+    -------
+    list of [int, int]
+        Indel ids and their counts
+    """
+    
+    indel_counts = {}
+    for token, count in Counter(indel_tokens).items():
+        indel_id = indel_table.intern_token(token, get_indel_string)
+        indel_counts[indel_id] = indel_counts.get(indel_id, 0) + count
+    return [[indel_id, count] for indel_id, count in indel_counts.items()]
+
+
+def parse_sample_columns(ref_base, read_count, read_bases, qualities, indel_table=INDEL_TABLE):
+    """ Removes irrelevant characters from read of one sample, counts bases,
+    detects insertions and deletions and returns a dictionary with all
+    relevant information.
+    
+    Parameters
+    ----------
+    ref_base: str
+        Reference base at the position
+    read_count: str
+        Read count column of the sample
+    read_bases: str
+        Read results column of the sample
+    qualities: str
+        Read qualities column of the sample
+    indel_table: IndelTable
+        Table to intern indels into
+        
+    Returns
+    -------
+    dict
+        A dictionary containing sample information at the position
+    """
+    
+    sample_info = {}
+    sample_info['ref_base'] = ref_base
+    sample_info['read_count'] = int(read_count)
+    sample_info['read_bases'] = read_bases
+    sample_info['qualities'] = qualities
+
+    #sample_info['average_quality'] = get_average_quality(qualities)
+
+    sample_info['A'] = 0
+    sample_info['C'] = 0
+    sample_info['G'] = 0
+    sample_info['T'] = 0
+
+    read_bases = preprocess_bases(sample_info['read_bases'])
+
+    ins = re.findall(r'[\.][+][ACGT]*[0-9]*[ACGT]*[0-9]*[ACGT]*', read_bases)
+    dels = re.findall(r'[\.][-][ACGT]*[0-9]*[ACGT]*[0-9]*[ACGT]*', read_bases)
+    insertion_variants = list(set(ins))
+    deletition_variants = list(set(dels))
+
+    insertion_variants.sort(key = len, reverse = True)
+    for s in insertion_variants:
+        read_bases = read_bases.replace(s,'')
+
+    deletition_variants.sort(key = len, reverse = True)
+    for s in deletition_variants:
+        read_bases = read_bases.replace(s,'')
+
+    sample_info['insertions'] = count_indels(ins, indel_table)
+    sample_info['deletitions'] = count_indels(dels, indel_table)
+
+    read_bases = read_bases.replace('.', sample_info['ref_base'])
+    base_counter = count_bases(read_bases)
+
+    for base in base_counter:
+        sample_info[base[0]] = base[1]
+    
+    return sample_info
+
+
+def get_sample_count(split_line, line):
+    """ Returns number of samples in a pileup line, checking that it has
+    the shared columns and three columns for every sample
+    
+    Parameters
+    ----------
+    split_line: list of str
+        Columns of the pileup line
+    line: str
+        The pileup line, for the error message
+        
+    Returns
+    -------
+    int
+        Number of samples
+    """
+    
+    if len(split_line) < 6 or (len(split_line) - 3) % 3 != 0:
+        raise ValueError('Pileup line has {} columns, expected 3 and 3 per sample: {!r}'.format(
+            len(split_line), line))
+    return (len(split_line) - 3) // 3
+
+
+def parse_pileup_line(line, indel_table=INDEL_TABLE):
+    """ Parses one pileup line. Every sample has its own read count, read
+    results and qualities columns after the shared chromosome, position and
+    reference base columns.
+    
+    Parameters
+    ----------
+    line: str
+        One line of a pileup file
+    indel_table: IndelTable
+        Table to intern indels into
+        
+    Returns
+    -------
+    dict
+        A dictionary containing pileup line information. With more than one
+        sample, information of each sample is under 'samples' key
+    """
+    
+    split_line = line.rstrip('\r\n').split('\t')
+    sample_count = get_sample_count(split_line, line)
+
+    pileup_line = {}
+    pileup_line['chromosome'] = split_line[0]
+    pileup_line['position'] = int(split_line[1])
+    if sample_count == 1:
+        pileup_line.update(parse_sample_columns(*split_line[2:6], indel_table=indel_table))
+        return pileup_line
+
+    pileup_line['ref_base'] = split_line[2]
+    pileup_line['samples'] = [parse_sample_columns(split_line[2], *split_line[3 + 3 * sample:6 + 3 * sample],
+                                                   indel_table=indel_table)
+                              for sample in range(sample_count)]
+    return pileup_line
+
+
+def count_pileup_samples(path):
+    """ Returns number of samples in a pileup file, read from its first line
+    
+    Parameters
+    ----------
+    path: str
+        Path to the pileup file
+        
+    Returns
+    -------
+    int
+        Number of samples
+    """
+    
+    with open(path, 'r') as pileup_file:
+        line = pileup_file.readline()
+    if not line:
+        return 1
+    return get_sample_count(line.rstrip('\r\n').split('\t'), line)
+
+
+def pileup_reader(path, indel_table=INDEL_TABLE):
     """ Reads pileup file, removes irrelevant characters from read, 
     counts bases, detects insertions and deletions and returnes a dictionary
     with all relevant information.
@@ -108,6 +277,8 @@ def pileup_reader(path):
     ----------
     path: str
         Path to the pileup file
+    indel_table: IndelTable
+        Table to intern indels into
         
     Yields
     ------
@@ -116,63 +287,91 @@ def pileup_reader(path):
     """
     
     with open(path, 'r') as pileup_file:
-        i = 0
-        for line in pileup_file.readlines():
-            split_line = line.split()
-            
-            pileup_line = {}
-            pileup_line['chromosome'] = split_line[0]
-            pileup_line['position'] = int(split_line[1])
-            pileup_line['ref_base'] = split_line[2]
-            pileup_line['read_count'] = int(split_line[3])
-            pileup_line['read_bases'] = split_line[4]
-            pileup_line['qualities'] = split_line[5]
-            
-            #pileup_line['average_quality'] = get_average_quality(split_line[5])
-            
-            pileup_line['A'] = 0
-            pileup_line['C'] = 0
-            pileup_line['G'] = 0
-            pileup_line['T'] = 0
-            
-            read_bases = preprocess_bases(pileup_line['read_bases'])
-            
-            ins = re.findall(r'[\.][+][ACGT]*[0-9]*[ACGT]*[0-9]*[ACGT]*', read_bases)
-            dels = re.findall(r'[\.][-][ACGT]*[0-9]*[ACGT]*[0-9]*[ACGT]*', read_bases)
-            var_insertion = []
-            var_deletition = []
-            insertion_variants = list(set(ins))
-            deletition_variants = list(set(dels))
-            
-            insertion_variants1 = [get_indel_string(var) for var in insertion_variants]
-            deletition_variants1 = [get_indel_string(var) for var in deletition_variants]
-            
-            var_counts_insertion = [ins.count(indel) for indel in insertion_variants]
-            for i in range(0, len(insertion_variants1)):
-                var_insertion.append([insertion_variants1[i], var_counts_insertion[i]])
-                
-            var_counts_deletition = [dels.count(indel) for indel in deletition_variants]
-            for i in range(0, len(deletition_variants1)):
-                var_deletition.append([deletition_variants1[i], var_counts_deletition[i]])
-            
-            insertion_variants.sort(key = len, reverse = True)
-            for s in insertion_variants:
-                read_bases = read_bases.replace(s,'')
-                
-            deletition_variants.sort(key = len, reverse = True)
-            for s in deletition_variants:
-                read_bases = read_bases.replace(s,'')
-                
-            pileup_line['insertions'] = var_insertion
-            pileup_line['deletitions'] = var_deletition
-            
-            read_bases = read_bases.replace('.', pileup_line['ref_base'])
-            base_counter = count_bases(read_bases)
-            
-            for base in base_counter:
-                pileup_line[base[0]] = base[1]
-            
-            yield pileup_line
+        for line in pileup_file:
+            yield parse_pileup_line(line, indel_table)
+
+
+def build_pileup_index(path, step=1000):
+    """ Indexes a pileup file sorted by position, remembering the byte offset
+    of the first line of every chromosome and of every step-th line after it.
+    
+    Parameters
+    ----------
+    path: str
+        Path to the pileup file
+    step: int
+        How many lines to skip between two indexed lines
+        
+    Returns
+    -------
+    dict
+        Lists of indexed positions and their byte offsets for each chromosome
+    """
+    
+    index = {}
+    with open(path, 'rb') as pileup_file:
+        offset = 0
+        lines_since_indexed = 0
+        for line in pileup_file:
+            split_line = line.split(maxsplit=2)
+            if len(split_line) < 3:
+                raise ValueError('Not a pileup line: {!r}'.format(line))
+            chromosome = split_line[0].decode()
+            if chromosome not in index:
+                index[chromosome] = ([], [])
+                lines_since_indexed = step
+            if lines_since_indexed >= step:
+                positions, offsets = index[chromosome]
+                positions.append(int(split_line[1]))
+                offsets.append(offset)
+                lines_since_indexed = 0
+            lines_since_indexed += 1
+            offset += len(line)
+    return index
+
+
+def pileup_region_reader(path, index, chromosome, start=None, end=None, indel_table=INDEL_TABLE):
+    """ Reads only the lines of a pileup file inside the given region,
+    seeking to it using an index built by build_pileup_index.
+    
+    Parameters
+    ----------
+    path: str
+        Path to the pileup file
+    index: dict
+        Index of the pileup file
+    chromosome: str
+        Chromosome of the region
+    start: int
+        First position of the region, or None to start from the beginning
+    end: int
+        Last position of the region, or None to read to the end of chromosome
+    indel_table: IndelTable
+        Table to intern indels into
+        
+    Yields
+    ------
+    dict
+        A dictionary containing pileup line information
+    """
+    
+    if chromosome not in index:
+        return
+    positions, offsets = index[chromosome]
+    indexed = 0 if start is None else max(bisect.bisect_right(positions, start) - 1, 0)
+    
+    with open(path, 'rb') as pileup_file:
+        pileup_file.seek(offsets[indexed])
+        for line in pileup_file:
+            split_line = line.split(maxsplit=2)
+            if split_line[0].decode() != chromosome:
+                break
+            position = int(split_line[1])
+            if start is not None and position < start:
+                continue
+            if end is not None and position > end:
+                break
+            yield parse_pileup_line(line.decode(), indel_table)
             
                 
 if __name__ == '__main__':
@@ -0,0 +1,60 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def time_command(command, repeats):
+    """ Runs a command in a fresh interpreter several times and measures
+    its wall time, so that interpreter startup and imports are included.
+
+    Parameters
+    ----------
+    command: list of str
+        Command to run
+    repeats: int
+        How many times to run the command
+
+    Returns
+    -------
+    (float, float)
+        Best and average wall time in seconds
+    """
+
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.time() - start)
+    return min(times), sum(times) / len(times)
+
+def main():
+    """ Measures how long a fresh interpreter takes to start, to import the
+    calling modules and to call a small region end to end.
+    """
+
+    parser = argparse.ArgumentParser(description='Measures startup time of the variant caller')
+    parser.add_argument('--input-file', default='test_data/test.pileup', type=str,
+                        help='path to a small input file in pileup format')
+    parser.add_argument('--repeats', default='10', type=int,
+                        help='how many times to run each measurement')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_file = os.path.join(tmp_dir, 'out.vcf')
+        benchmarks = [
+            ('Interpreter', [sys.executable, '-c', 'pass']),
+            ('Import main', [sys.executable, '-c', 'import main']),
+            ('Import metrics', [sys.executable, '-c', 'import metrics']),
+            ('Help', [sys.executable, 'main.py', '--help']),
+            ('Region call', [sys.executable, 'main.py', '--input-file', args.input_file,
+                             '--output-file', output_file]),
+        ]
+        for name, command in benchmarks:
+            best, average = time_command(command, args.repeats)
+            print('{}: best {:.3f}s, average {:.3f}s'.format(name, best, average))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+import json
+import os
+import resource
+import sys
+import time
+
+def get_rss():
+    """ Returns resident set size of the current process
+
+    Returns
+    -------
+    int
+        Resident set size in bytes
+    """
+
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # Without /proc only the peak is available, in bytes on macOS and kilobytes elsewhere
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+class MemoryBudget(object):
+    """ Adapts batch size to keep resident set size under a target. Batches
+    are halved when RSS gets close to the budget and slowly grown back while
+    there is room left.
+    """
+
+    def __init__(self, budget, max_batch_size, min_batch_size=100):
+        """
+        Parameters
+        ----------
+        budget: int
+            Target resident set size in bytes, or None for no budget
+        max_batch_size: int
+            Largest batch size to grow to
+        min_batch_size: int
+            Smallest batch size to shrink to
+        """
+        self.budget = budget
+        self.max_batch_size = max_batch_size
+        self.min_batch_size = min(min_batch_size, max_batch_size)
+        self.batch_size = max_batch_size
+
+    def over_budget(self, rss=None):
+        """ Returns whether RSS is close to the budget, so pending work
+        should be flushed before the batch is full
+
+        Parameters
+        ----------
+        rss: int
+            Resident set size in bytes, measured if not given
+
+        Returns
+        -------
+        bool
+            Whether RSS is over 90% of the budget
+        """
+        if self.budget is None:
+            return False
+        if rss is None:
+            rss = get_rss()
+        return rss > 0.9 * self.budget
+
+    def adapt(self, rss=None):
+        """ Measures RSS and updates batch size
+
+        Parameters
+        ----------
+        rss: int
+            Resident set size in bytes, measured if not given
+
+        Returns
+        -------
+        int
+            New batch size
+        """
+        if self.budget is None:
+            return self.batch_size
+        if rss is None:
+            rss = get_rss()
+        if self.over_budget(rss):
+            self.batch_size = max(self.batch_size // 2, self.min_batch_size)
+        elif rss < 0.7 * self.budget:
+            self.batch_size = min(self.batch_size + self.batch_size // 4 + 1, self.max_batch_size)
+        return self.batch_size
+
+class TelemetryLogger(object):
+    """ Periodically writes RSS, throughput and queue depth as JSON lines. """
+
+    def __init__(self, path, interval=10.0):
+        """
+        Parameters
+        ----------
+        path: str
+            Path to the telemetry log, or None to log nothing
+        interval: float
+            Minimum number of seconds between two records
+        """
+        self.log_file = open(path, 'w') if path is not None else None
+        self.interval = interval
+        self.start = time.time()
+        self.last = None
+
+    def update(self, position_count, queue_depth, batch_size, force=False):
+        """ Writes a telemetry record if the interval has passed since the last one
+
+        Parameters
+        ----------
+        position_count: int
+            Number of positions processed so far
+        queue_depth: int
+            Number of positions read but not yet called and written
+        batch_size: int
+            Current batch size
+        force: bool
+            Whether to write the record regardless of the interval
+        """
+        if self.log_file is None:
+            return
+        now = time.time()
+        if not force and self.last is not None and now - self.last < self.interval:
+            return
+        self.last = now
+        elapsed = now - self.start
+        record = {
+            'time': now,
+            'elapsed': elapsed,
+            'rss': get_rss(),
+            'positions': position_count,
+            'positions_per_second': position_count / elapsed if elapsed > 0 else 0.0,
+            'queue_depth': queue_depth,
+            'batch_size': batch_size,
+        }
+        self.log_file.write(json.dumps(record) + '\n')
+        self.log_file.flush()
+
+    def close(self):
+        if self.log_file is not None:
+            self.log_file.close()
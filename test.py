@@ -1,6 +1,21 @@
 import unittest
-from pileup_reader import pileup_reader, preprocess_bases, get_indel_string
+from pileup_reader import pileup_reader, preprocess_bases, get_indel_string, \
+    build_pileup_index, pileup_region_reader, parse_pileup_line, count_pileup_samples
 from variant_caller import VariantCaller
+from indel_table import INDEL_TABLE, IndelTable
+from metrics import get_curve, get_scored_records
+from calling_service import CallingService, parse_region, create_handler
+from vcf_writer import create_vcf_header, create_vcf_record, create_vcf_file, write_vcf_line, \
+    merge_vcf_shards, reg2bin
+from telemetry import MemoryBudget, TelemetryLogger, get_rss
+import json
+import os
+import shutil
+import tempfile
+import threading
+import urllib.error
+import urllib.request
+import numpy as np
 
 class TestPreprocess(unittest.TestCase):
     def test_empty(self):
@@ -40,7 +55,7 @@ class TestPileupReader(unittest.TestCase):
                         'read_bases': '...,..,....,,............,.,..........-1A,,,,,,...,.,...,..,.,,..,...........,..,,.,........^],',
                         'qualities': 'fA]@@ZA_HhGGG<rgAJpIkGCoKJIBV=AFIJJJHk@8B@BFIGF>J@eJA9CJ0II>FFBJJ<IBHJJHJJEDH@8AEHJFHCG?AC',
                         'A': 0, 'C': 0, 'G': 89, 'T': 0,
-                        'insertions': [], 'deletitions': [['A', 1]]})
+                        'insertions': [], 'deletitions': [[INDEL_TABLE.intern('DEL', 'A'), 1]]})
     
         i = 0
         for item in pileup_reader('test_data/test.pileup'):
@@ -131,6 +146,377 @@ class TestVariantCaller(unittest.TestCase):
         test_one_delete_one_insert(variant_caller)
         test_two_deletes(variant_caller)
 
+class TestGenotypeLikelihoods(unittest.TestCase):
+    def test_triallelic(self):
+        variant_caller = VariantCaller()
+        # G and T are tied behind A, genotypes over all alleles keep the reference one
+        mockPositionInfo = { 'A' : 28, 'G': 9, 'C' : 6, 'T' : 9, 'ref_base' : 'G'}
+        variant_caller.call_variant(mockPositionInfo, 0.99)
+        self.assertEqual(mockPositionInfo['genotype'], (0, 1))
+        self.assertEqual(mockPositionInfo['alts'], ['A'])
+
+        mockPositionInfo = { 'A' : 0, 'G': 10, 'C' : 1, 'T' : 10, 'ref_base' : 'A'}
+        variant_caller.call_variant(mockPositionInfo, 0.99)
+        self.assertEqual(mockPositionInfo['genotype'], (1, 2))
+        self.assertEqual(mockPositionInfo['alts'], ['G', 'T'])
+
+    def test_batch(self):
+        variant_caller = VariantCaller()
+        batch = [{ 'A' : 8, 'G' : 1, 'C' : 1, 'T' : 1 , 'ref_base' : 'A'},
+                 { 'A' : 1, 'G' : 7, 'C' : 1, 'T' : 8 , 'ref_base' : 'G'},
+                 { 'A' : 0, 'G' : 0, 'C' : 0, 'T' : 0 , 'ref_base' : 'G'},
+                 { 'A' : 1, 'G': 1, 'C' : 1, 'T' : 1, 'ref_base' : 'T',
+                   'deletitions': [('ACAC', 8), ('AC', 7)]}]
+        variant_caller.call_variants(batch, 0.8)
+        self.assertEqual([position['genotype'] for position in batch], [(0, 0), (0, 1), (0, 0), (1, 2)])
+        self.assertEqual(batch[1]['alts'], ['T'])
+        self.assertEqual(batch[2]['vaf'], 1)
+        self.assertEqual(batch[3]['alts'], ['T', 'TAC'])
+
+    def test_indel_heavy_row(self):
+        variant_caller = VariantCaller()
+        def indel_heavy_row():
+            deletitions = [('A' * length, 1) for length in range(1, 61)]
+            deletitions[9] = ('A' * 10, 12)
+            return { 'A' : 10, 'G': 0, 'C' : 0, 'T' : 1, 'ref_base' : 'A', 'deletitions': deletitions}
+        
+        # One position with 60 deletions does not make the whole batch score 64 alleles
+        batch = [{ 'A' : 9, 'G' : 1, 'C' : 0, 'T' : 0 , 'ref_base' : 'A'} for _ in range(10000)]
+        batch[5000] = indel_heavy_row()
+        variant_caller.call_variants(batch, 0.99, genotype_likelihoods=True)
+        alone = indel_heavy_row()
+        variant_caller.call_variant(alone, 0.99, genotype_likelihoods=True)
+        
+        self.assertEqual(batch[5000]['genotype'], (0, 1))
+        self.assertEqual(batch[5000]['alts'], ['A'])
+        for key in ('genotype', 'ref_base', 'alts', 'vaf', 'gl', 'pl'):
+            self.assertEqual(batch[5000][key], alone[key])
+        self.assertEqual({position['genotype'] for position in batch[:5000] + batch[5001:]}, {(0, 0)})
+
+    def test_unrelated_indel(self):
+        variant_caller = VariantCaller()
+        # A single read with an insertion does not make an error on the bases less likely
+        mockPositionInfo = { 'A' : 22, 'G': 3, 'C' : 0, 'T' : 0, 'ref_base' : 'A'}
+        variant_caller.call_variant(mockPositionInfo, 0.99)
+        self.assertEqual(mockPositionInfo['genotype'], (0, 0))
+        
+        mockPositionInfo = { 'A' : 22, 'G': 3, 'C' : 0, 'T' : 0, 'ref_base' : 'A', 'insertions': [('CT', 1)]}
+        variant_caller.call_variant(mockPositionInfo, 0.99)
+        self.assertEqual(mockPositionInfo['genotype'], (0, 0))
+        self.assertEqual(mockPositionInfo['alts'], '.')
+
+    def test_gl_pl(self):
+        variant_caller = VariantCaller()
+        mockPositionInfo = { 'A' : 1, 'G' : 7, 'C' : 1, 'T' : 8 , 'ref_base' : 'G'}
+        variant_caller.call_variant(mockPositionInfo, 0.8, genotype_likelihoods=True)
+        self.assertEqual(len(mockPositionInfo['gl']), 3)
+        self.assertEqual(mockPositionInfo['pl'][1], 0)
+        self.assertEqual(min(mockPositionInfo['pl']), 0)
+
+        mockPositionInfo = { 'A' : 8, 'G' : 1, 'C' : 1, 'T' : 1 , 'ref_base' : 'A'}
+        variant_caller.call_variant(mockPositionInfo, 0.8, genotype_likelihoods=True)
+        self.assertEqual(mockPositionInfo['pl'], [0])
+
+class TestMetricsCurve(unittest.TestCase):
+    def test_normal(self):
+        scores = np.array([0.9, 0.5, 0.7, 0.7, 1.0, 0.3, 0.8])
+        called = np.array([True, True, True, True, False, False, True])
+        true = np.array([True, False, True, False, True, False, False])
+        thresholds, tp, fp, fn, tn = get_curve(scores, called, true)
+        
+        np.testing.assert_array_equal(thresholds, [0.9, 0.8, 0.7, 0.5])
+        for i, threshold in enumerate(thresholds):
+            predicted = called & (scores >= threshold)
+            self.assertEqual(tp[i], np.count_nonzero(predicted & true))
+            self.assertEqual(fp[i], np.count_nonzero(predicted & ~true))
+            self.assertEqual(fn[i], np.count_nonzero(~predicted & true))
+            self.assertEqual(tn[i], np.count_nonzero(~predicted & ~true))
+
+    def test_no_calls(self):
+        scores = np.array([0.9, 0.5, 0.7])
+        called = np.array([False, False, False])
+        true = np.array([True, False, False])
+        thresholds, tp, fp, fn, tn = get_curve(scores, called, true)
+        
+        self.assertEqual(len(thresholds), 1)
+        self.assertEqual((tp[0], fp[0], fn[0], tn[0]), (0, 0, 1, 2))
+        
+        thresholds, tp, fp, fn, tn = get_curve(np.array([]), np.array([], dtype=bool), np.array([], dtype=bool))
+        self.assertEqual((tp[0], fp[0], fn[0], tn[0]), (0, 0, 0, 0))
+
+    def test_scored_records(self):
+        pileup_lines = list(pileup_reader('test_data/multi_sample.pileup'))
+        VariantCaller().call_variants(pileup_lines, 0.9)
+        samples = ['normal', 'tumor', 'other']
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            paths = []
+            for path_samples in (['HCC1143BL', 'tumor', 'other'], samples):
+                paths.append(os.path.join(tmp_dir, '{}.vcf'.format(path_samples[0])))
+                vcf = create_vcf_file(paths[-1], path_samples)
+                for pileup_line in pileup_lines:
+                    write_vcf_line(pileup_line, vcf, path_samples)
+                vcf.close()
+            
+            # The first sample in the header is scored by default
+            scores, called, true = get_scored_records(*paths)
+            np.testing.assert_array_equal(called, [True, True])
+            np.testing.assert_array_equal(true, [True, True])
+            
+            scores, called, true = get_scored_records(*paths, sample='other')
+            np.testing.assert_array_equal(called, [True, False])
+            np.testing.assert_array_equal(scores, [float(line['samples'][2]['vaf']) for line in pileup_lines])
+
+class TestPileupRegionReader(unittest.TestCase):
+    def test_normal(self):
+        path = 'test_data/test.pileup'
+        for step in [1, 2, 1000]:
+            index = build_pileup_index(path, step)
+            self.assertEqual(sorted(index), ['21', '22'])
+            
+            positions = [item['position'] for item in pileup_region_reader(path, index, '21')]
+            self.assertEqual(positions, [9483252, 9483266])
+            positions = [item['position'] for item in pileup_region_reader(path, index, '21', 9483253)]
+            self.assertEqual(positions, [9483266])
+            positions = [item['position'] for item in pileup_region_reader(path, index, '21', 9483200, 9483260)]
+            self.assertEqual(positions, [9483252])
+            positions = [item['position'] for item in pileup_region_reader(path, index, '22', 1, 100)]
+            self.assertEqual(positions, [])
+            positions = [item['position'] for item in pileup_region_reader(path, index, 'X')]
+            self.assertEqual(positions, [])
+            
+        region_lines = list(pileup_region_reader(path, index, '22'))
+        self.assertEqual(region_lines, list(pileup_reader(path))[2:])
+
+class TestCallingService(unittest.TestCase):
+    def test_parse_region(self):
+        self.assertEqual(parse_region('21'), ('21', None, None))
+        self.assertEqual(parse_region('21:100'), ('21', 100, None))
+        self.assertEqual(parse_region('21:1,000-2,000'), ('21', 1000, 2000))
+        
+    def test_call_region(self):
+        service = CallingService()
+        records = service.call_region('test_data/test.pileup', '21:9483260-9483270').splitlines()
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].split('\t')[:5], ['21', '9483266', '.', 'T', '.'])
+        
+        records = service.call_region('test_data/test.pileup', '21', genotype_likelihoods=True).splitlines()
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0].split('\t')[8], 'GT:VAF:GL:PL')
+        self.assertEqual(len(service.indexes), 1)
+        self.assertEqual(len(service.headers), 2)
+
+    def test_data_dir(self):
+        service = CallingService(data_dir='test_data')
+        self.assertEqual(service.resolve_input('test.pileup'), os.path.realpath('test_data/test.pileup'))
+        with self.assertRaises(PermissionError):
+            service.resolve_input('../main.py')
+        with self.assertRaises(PermissionError):
+            service.resolve_input('/etc/passwd')
+        
+    def test_handler(self):
+        from http.server import ThreadingHTTPServer
+        
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            shutil.copy('test_data/test.pileup', tmp_dir)
+            with open(os.path.join(tmp_dir, 'bad.pileup'), 'w') as bad_file:
+                bad_file.write('root:x:0:0:root:/root:/bin/bash\n')
+            
+            server = ThreadingHTTPServer(('127.0.0.1', 0), create_handler(CallingService(data_dir=tmp_dir)))
+            server.RequestHandlerClass.log_message = lambda *args: None
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            def get(path):
+                url = 'http://127.0.0.1:{}{}'.format(server.server_port, path)
+                try:
+                    with urllib.request.urlopen(url) as response:
+                        return response.status, response.read().decode()
+                except urllib.error.HTTPError as error:
+                    return error.code, None
+            
+            try:
+                status, body = get('/header?samples=2')
+                self.assertEqual(status, 200)
+                self.assertTrue(body.rstrip().endswith('SAMPLE1\tSAMPLE2'))
+                
+                status, body = get('/call?input=test.pileup&region=21:9483260-9483270')
+                self.assertEqual(status, 200)
+                self.assertEqual(body.split('\t')[:2], ['21', '9483266'])
+                
+                self.assertEqual(get('/call?input=/etc/passwd&region=root')[0], 403)
+                self.assertEqual(get('/call?input=bad.pileup&region=root')[0], 400)
+                self.assertEqual(get('/call?input=test.pileup')[0], 400)
+                self.assertEqual(get('/unknown')[0], 404)
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+
+class TestMultiSample(unittest.TestCase):
+    def test_reader(self):
+        pileup_lines = list(pileup_reader('test_data/multi_sample.pileup'))
+        self.assertEqual(len(pileup_lines), 2)
+        self.assertEqual(pileup_lines[0]['ref_base'], 'A')
+        self.assertEqual(len(pileup_lines[0]['samples']), 3)
+        self.assertEqual([sample['T'] for sample in pileup_lines[0]['samples']], [1, 0, 4])
+        self.assertEqual(pileup_lines[1]['samples'][0]['insertions'], [[INDEL_TABLE.intern('INS', 'ACAC'), 3]])
+        self.assertEqual(pileup_lines[1]['samples'][2]['read_count'], 0)
+        
+    def test_malformed(self):
+        self.assertEqual(count_pileup_samples('test_data/multi_sample.pileup'), 3)
+        with self.assertRaises(ValueError):
+            parse_pileup_line('1\t100\tA\t0\n')
+        with self.assertRaises(ValueError):
+            parse_pileup_line('1\t100\tA\t1\t.\tI\t1\t.\n')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'short.pileup')
+            with open(path, 'w') as pileup_file:
+                pileup_file.write('1\t100\tA\t0\n')
+            with self.assertRaises(ValueError):
+                count_pileup_samples(path)
+        
+    def test_vcf_record(self):
+        pileup_lines = list(pileup_reader('test_data/multi_sample.pileup'))
+        VariantCaller().call_variants(pileup_lines, 0.9, genotype_likelihoods=True)
+        samples = ['SAMPLE1', 'SAMPLE2', 'SAMPLE3']
+        header = create_vcf_header(samples, genotype_likelihoods=True)
+        
+        record = create_vcf_record(pileup_lines[0], header, samples)
+        self.assertEqual(record.alleles, ('A', 'C', 'T'))
+        self.assertEqual([record.samples[sample]['GT'] for sample in samples], [(0, 1), (0, 0), (2, 2)])
+        self.assertEqual(record.samples['SAMPLE3']['PL'][1:3], (None, None))
+        
+        # Alleles of every sample are normalized to the longest reference
+        record = create_vcf_record(pileup_lines[1], header, samples)
+        self.assertEqual(record.ref, 'GTTTT')
+        self.assertEqual(record.alts, ('GACACTTTT', 'G'))
+        self.assertEqual([record.samples[sample]['GT'] for sample in samples], [(0, 1), (0, 2), (0, 0)])
+
+class TestTelemetry(unittest.TestCase):
+    def test_memory_budget(self):
+        self.assertGreater(get_rss(), 0)
+        
+        memory_budget = MemoryBudget(None, 1000)
+        self.assertFalse(memory_budget.over_budget())
+        self.assertEqual(memory_budget.adapt(), 1000)
+        
+        memory_budget = MemoryBudget(100, 1000)
+        self.assertTrue(memory_budget.over_budget(95))
+        self.assertEqual(memory_budget.adapt(95), 500)
+        self.assertEqual(memory_budget.adapt(95), 250)
+        self.assertEqual(memory_budget.adapt(95), 125)
+        self.assertEqual(memory_budget.adapt(95), 100)
+        self.assertEqual(memory_budget.adapt(80), 100)
+        self.assertEqual(memory_budget.adapt(50), 126)
+        for _ in range(20):
+            memory_budget.adapt(50)
+        self.assertEqual(memory_budget.batch_size, 1000)
+        
+    def test_logger(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'telemetry.jsonl')
+            telemetry = TelemetryLogger(path, interval=3600)
+            telemetry.update(10, 5, 100)
+            telemetry.update(20, 5, 100)
+            telemetry.update(30, 0, 100, force=True)
+            telemetry.close()
+            with open(path) as log_file:
+                records = [json.loads(line) for line in log_file]
+        self.assertEqual([record['positions'] for record in records], [10, 30])
+        self.assertEqual(records[0]['queue_depth'], 5)
+        self.assertGreater(records[0]['rss'], 0)
+
+class TestMergeShards(unittest.TestCase):
+    def test_reg2bin(self):
+        self.assertEqual(reg2bin(0, 1), 4681)
+        self.assertEqual(reg2bin(16384, 16385), 4682)
+        self.assertEqual(reg2bin(16000, 17000), 585)
+        self.assertEqual(reg2bin(0, 1 << 29), 0)
+        
+    def test_normal(self):
+        import pysam
+        
+        pileup_lines = list(pileup_reader('test_data/test.pileup'))
+        VariantCaller().call_variants(pileup_lines)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # Shards are given out of contig order, merge follows the .fai
+            shard_paths = []
+            for shard, shard_lines in enumerate([pileup_lines[2:], pileup_lines[1:2], pileup_lines[:1]]):
+                shard_paths.append(os.path.join(tmp_dir, 'shard{}.vcf'.format(shard)))
+                vcf = create_vcf_file(shard_paths[-1], 'SAMPLE1')
+                for pileup_line in shard_lines:
+                    write_vcf_line(pileup_line, vcf, 'SAMPLE1')
+                vcf.close()
+            
+            path = os.path.join(tmp_dir, 'merged.vcf.gz')
+            self.assertEqual(merge_vcf_shards(shard_paths, path), 3)
+            self.assertTrue(os.path.exists(path + '.tbi'))
+            
+            vcf = pysam.VariantFile(path)
+            self.assertEqual([(record.chrom, record.pos) for record in vcf.fetch()],
+                             [('21', 9483252), ('21', 9483266), ('22', 41616770)])
+            self.assertEqual([record.pos for record in vcf.fetch('21', 9483260, 9483300)], [9483266])
+            self.assertEqual([record.pos for record in vcf.fetch('22')], [41616770])
+            self.assertEqual(list(vcf.fetch('1')), [])
+            vcf.close()
+
+class TestIndelTable(unittest.TestCase):
+    def test_normal(self):
+        indel_table = IndelTable()
+        self.assertEqual(indel_table.intern('INS', 'AC'), 0)
+        self.assertEqual(indel_table.intern('DEL', 'AC'), 1)
+        self.assertEqual(indel_table.intern('INS', 'AC'), 0)
+        self.assertEqual(indel_table.allele(1), ('AC', 'DEL'))
+        self.assertEqual(len(indel_table), 2)
+        
+    def test_reader_interns(self):
+        path = 'test_data/multi_sample.pileup'
+        first = list(pileup_reader(path))
+        table_size = len(INDEL_TABLE)
+        second = list(pileup_reader(path))
+        self.assertEqual(first, second)
+        self.assertEqual(len(INDEL_TABLE), table_size)
+        
+        # Repeated tokens of one indel are counted under one id
+        sample_info = first[1]['samples'][1]
+        self.assertEqual(sample_info['deletitions'], [[INDEL_TABLE.intern('DEL', 'TTTT'), 3]])
+        
+    def test_caller_ids(self):
+        variant_caller = VariantCaller()
+        mockPositionInfo = { 'A' : 1, 'G': 1, 'C' : 1, 'T' : 1, 'ref_base' : 'T',
+                            'deletitions': [[INDEL_TABLE.intern('DEL', 'ACAC'), 8]],
+                            'insertions' : [[INDEL_TABLE.intern('INS', 'GT'), 7]]}
+        variant_caller.call_variant(mockPositionInfo)
+        self.assertEqual(mockPositionInfo['genotype'], (1, 2))
+        self.assertEqual(mockPositionInfo['alts'], ['T', 'TGTACAC'])
+        self.assertEqual(mockPositionInfo['ref_base'], 'TACAC')
+
+    def test_scoped_table(self):
+        path = 'test_data/multi_sample.pileup'
+        indel_table = IndelTable()
+        self.assertEqual(indel_table.intern_token('.-1A', get_indel_string), 0)
+        self.assertEqual(indel_table.intern_token('.-1A', get_indel_string), 0)
+        self.assertEqual(indel_table.allele(0), ('A', 'DEL'))
+        
+        # A table of its own leaves the global one untouched and calls the same
+        shared = list(pileup_reader(path))
+        table_size = len(INDEL_TABLE)
+        indel_table = IndelTable()
+        scoped = list(pileup_reader(path, indel_table))
+        self.assertEqual(len(INDEL_TABLE), table_size)
+        variant_caller = VariantCaller()
+        variant_caller.call_variants(scoped, indel_table=indel_table)
+        variant_caller.call_variants(shared)
+        self.assertEqual([[(sample['genotype'], sample['alts']) for sample in line['samples']] for line in scoped],
+                         [[(sample['genotype'], sample['alts']) for sample in line['samples']] for line in shared])
+
+    def test_clear(self):
+        indel_table = IndelTable()
+        lines = list(pileup_reader('test_data/multi_sample.pileup', indel_table))
+        self.assertGreater(len(indel_table), 0)
+        indel_table.clear()
+        self.assertEqual((len(indel_table), indel_table.token_ids), (0, {}))
+        self.assertEqual(list(pileup_reader('test_data/multi_sample.pileup', indel_table)), lines)
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(TestPreprocess('test_empty'))
@@ -139,6 +525,31 @@ def suite():
     suite.addTest(TestPileupReader('test_normal'))
     suite.addTest(TestVariantCaller('test_normal'))
     suite.addTest(TestVariantCaller('test_indels'))
+    suite.addTest(TestGenotypeLikelihoods('test_triallelic'))
+    suite.addTest(TestGenotypeLikelihoods('test_batch'))
+    suite.addTest(TestGenotypeLikelihoods('test_indel_heavy_row'))
+    suite.addTest(TestGenotypeLikelihoods('test_unrelated_indel'))
+    suite.addTest(TestGenotypeLikelihoods('test_gl_pl'))
+    suite.addTest(TestMetricsCurve('test_normal'))
+    suite.addTest(TestMetricsCurve('test_no_calls'))
+    suite.addTest(TestMetricsCurve('test_scored_records'))
+    suite.addTest(TestPileupRegionReader('test_normal'))
+    suite.addTest(TestCallingService('test_parse_region'))
+    suite.addTest(TestCallingService('test_call_region'))
+    suite.addTest(TestCallingService('test_data_dir'))
+    suite.addTest(TestCallingService('test_handler'))
+    suite.addTest(TestMultiSample('test_reader'))
+    suite.addTest(TestMultiSample('test_malformed'))
+    suite.addTest(TestMultiSample('test_vcf_record'))
+    suite.addTest(TestTelemetry('test_memory_budget'))
+    suite.addTest(TestTelemetry('test_logger'))
+    suite.addTest(TestMergeShards('test_reg2bin'))
+    suite.addTest(TestMergeShards('test_normal'))
+    suite.addTest(TestIndelTable('test_normal'))
+    suite.addTest(TestIndelTable('test_reader_interns'))
+    suite.addTest(TestIndelTable('test_caller_ids'))
+    suite.addTest(TestIndelTable('test_scoped_table'))
+    suite.addTest(TestIndelTable('test_clear'))
     return suite
 
 def main():
@@ -1,54 +1,219 @@
+import math
 import numpy as np
-from scipy.stats import binom
+from operator import itemgetter
+from indel_table import INDEL_TABLE
+
+SNV_BASES = ('A', 'C', 'G', 'T')
+SNV_INDEX = {base: index for index, base in enumerate(SNV_BASES)}
+get_snv_counts = itemgetter(*SNV_BASES)
+
+
+def intern_indels(indels, indel_type, indel_table=INDEL_TABLE):
+    """ Returns indels with ids in the interned indel table. Indels read by
+    pileup_reader already have ids and are returned as they are, indel
+    strings are interned.
+
+    Parameters
+    ----------
+    indels: list of (int, int) or (str, int) tuples, or None
+        Indel ids or strings and their counts
+    indel_type: str
+        INS or DEL
+    indel_table: IndelTable
+        Table the indel ids belong to
+
+    Returns
+    -------
+    list of (int, int) tuples
+        Indel ids and their counts
+    """
+    if not indels:
+        return []
+    if isinstance(indels[0][0], str):
+        return [(indel_table.intern(indel_type, indel_string), count) for indel_string, count in indels]
+    return indels
+
 
 class VariantCaller(object):
     def __init__(self):
-        pass
+        self.__genotype_index_cache__ = {}
+
+    def __genotype_indices__(self, allele_count):
+        """ Returns (and caches) indices of all unordered allele pairs for a
+        given number of alleles, in VCF genotype order: 0/0, 0/1, 1/1, 0/2, ...
+
+        Parameters
+        ----------
+        allele_count: int
+            Number of alleles at a position
+
+        Returns
+        -------
+        (np.ndarray, np.ndarray)
+            First and second allele index of every diploid genotype
+        """
+        if allele_count not in self.__genotype_index_cache__:
+            second, first = np.tril_indices(allele_count)
+            self.__genotype_index_cache__[allele_count] = (first, second)
+        return self.__genotype_index_cache__[allele_count]
 
-    def __calculate_most_probable_variant__(self, candidate_variant_count, correct_probability):
+    def __genotype_log_likelihoods__(self, counts, correct_probability):
         """
         Parameters
         ----------
-        candidate_variant_count: List of (str, int) tuples
-            List with two most common variants and their counts
-        correct_probability: float
-            Probability that one nucleotide in a read is correct
-        
+        counts: np.ndarray
+            (positions x alleles) matrix of read counts, all positions with the same number of alleles
+        correct_probability: np.ndarray
+            Probability that one nucleotide in a read is correct, per position
+
         Returns
         -------
-        (List, float)
-        Chosen variants and estimated correctness probability
+        np.ndarray
+            (positions x genotypes) matrix of natural log likelihoods, in VCF genotype order
 
-        Given two most common variants v and v', we want to calculate the likelihood of each possible variant
-        P(variant | reads) = P(reads | variant) * P(variant) / P(reads)
-            => P(variant | reads) is proportional to P(reads | variant) if we ignore P(variant)
-        
-        If we have k v bases and n-k v' bases, and the correct probability for one read position of p:   
-            P(reads | variant is v) = C_nk * p^k * (1 - p)^(n-k)
-            P(reads | variant is v') = C_nk * p^(n - k) * (1 - p)^k
-            P(reads | variant is vv') = C_nk * (1/2)^n
+        Every read at a position is an observation of one of the K alleles (A, C, G, T and
+        every observed indel). A read coming from allele a shows a with probability p and
+        any other allele with probability e = (1 - p) / 3, the same as for a sequencing error
+        between bases, so that indels seen at a position do not change how likely an error
+        on its bases is. For a diploid genotype ab,
+        the read comes from a or b with probability 1/2 each, so for n reads out of which
+        n_a show a and n_b show b:
+            P(reads | genotype is aa) = p^n_a * e^(n - n_a)
+            P(reads | genotype is ab) = ((p + e) / 2)^(n_a + n_b) * e^(n - n_a - n_b)
 
-        We can cross out the C_nk as it doesn't affect the comparison. 
+        The multinomial coefficient is the same for every genotype, so we cross it out.
+        All genotypes of all positions are scored at once.
         """
-        first_candidate_variant, first_candidate_variant_count = candidate_variant_count[0]
-        second_candidate_variant, second_candidate_variant_count = candidate_variant_count[1]
-        n = first_candidate_variant_count + second_candidate_variant_count
-        k = first_candidate_variant_count
-
-        first_variant_likelihood = correct_probability ** k * (1 - correct_probability) ** (n - k)
-        second_variant_likelihood = (1 - correct_probability) ** k * correct_probability ** (n - k)
-        diploidy_likelihood = (1/2) ** n
-        total_likelihood = first_variant_likelihood + second_variant_likelihood + diploidy_likelihood
-
-        if first_variant_likelihood >= second_variant_likelihood and first_variant_likelihood >= diploidy_likelihood:
-            return ([first_candidate_variant], first_variant_likelihood / total_likelihood)
-        elif second_variant_likelihood >= first_variant_likelihood and second_variant_likelihood >= diploidy_likelihood:
-            return ([second_candidate_variant], second_variant_likelihood / total_likelihood)
-        else:
-            return ([first_candidate_variant, second_candidate_variant], diploidy_likelihood / total_likelihood)
-        
+        allele_count = counts.shape[1]
+        first, second = self.__genotype_indices__(allele_count)
+        correct_probability = np.clip(correct_probability, 1e-12, 1 - 1e-12)
+        error_probability = (1 - correct_probability) / (len(SNV_BASES) - 1)
+
+        log_correct = np.log(correct_probability)[:, None]
+        log_error = np.log(error_probability)[:, None]
+        log_half = np.log((correct_probability + error_probability) / 2)[:, None]
+
+        homozygous = first == second
+        total = counts.sum(axis=1)[:, None]
+        matching = np.where(homozygous, counts[:, first], counts[:, first] + counts[:, second])
+        log_likelihoods = matching * np.where(homozygous, log_correct, log_half) + (total - matching) * log_error
+        return log_likelihoods
+
+    def call_variants(self, genome_position_infos, correct_probability = 0.8, use_read_quality = False,
+                      genotype_likelihoods = False, indel_table = INDEL_TABLE):
+        """ Calls variants for a batch of positions, updating each genomePositionInfo dictionary
+        with chosen variant genotype, alts field, more
 
-    def call_variant(self, genomePositionInfo, correct_probability = 0.8, use_read_quality = False):
+        Parameters
+        ----------
+        genome_position_infos: list of dictionaries
+            All info about each of the pileup positions. Positions with more than one
+            sample are called for every sample under their 'samples' key
+        correct_probability: float
+            Probability that one nucleotide in a read is correct
+        use_read_quality: bool
+            Whether to use correct_probability estimate calculated using read qualities
+        genotype_likelihoods: bool
+            Whether to also store GL and PL values for the called alleles
+        indel_table: IndelTable
+            Table the indel ids of the positions belong to
+        """
+        # Every sample of every position is one row of the allele count matrix
+        genome_position_infos = [sample_info for genomePositionInfo in genome_position_infos
+                                 for sample_info in genomePositionInfo.get('samples', (genomePositionInfo,))]
+        if len(genome_position_infos) == 0:
+            return
+        if use_read_quality:
+            correct_probability = np.array([info['average_quality'] for info in genome_position_infos])
+
+        # Treat insertions and deletitions the same as SNVs, as extra allele columns after A, C, G, T
+        snv_counts = [get_snv_counts(info) for info in genome_position_infos]
+        indel_alleles = []
+        for genomePositionInfo in genome_position_infos:
+            insertions = genomePositionInfo.get('insertions')
+            deletitions = genomePositionInfo.get('deletitions')
+            if not insertions and not deletitions:
+                indel_alleles.append([])
+                continue
+            # Indels are ids in the interned indel table, strings are only looked up for called alleles
+            indel_alleles.append(intern_indels(insertions, 'INS', indel_table) +
+                                 intern_indels(deletitions, 'DEL', indel_table))
+
+        row_count = len(genome_position_infos)
+        allele_counts = len(SNV_BASES) + np.fromiter(map(len, indel_alleles), dtype=np.int64, count=row_count)
+        snv_matrix = np.array(snv_counts, dtype=np.float64).reshape(row_count, len(SNV_BASES))
+        correct_probability = np.broadcast_to(np.asarray(correct_probability, dtype=np.float64), (row_count,))
+        ref_columns = np.array([SNV_INDEX.get(info['ref_base'], -1) for info in genome_position_infos])
+        ref_genotypes = ref_columns * (ref_columns + 3) // 2
+
+        # Rows are scored in groups with the same number of alleles, so that one indel-heavy
+        # position does not pad the genotype matrix of the whole batch. VCF genotype order
+        # makes genotype indices of K alleles a prefix of those of any larger K.
+        best = np.zeros(row_count, dtype=np.int64)
+        confidences = np.ones(row_count)
+        ref_gl = np.zeros(row_count)
+        row_log_likelihoods = {}
+        for allele_count in np.unique(allele_counts).tolist():
+            group = np.flatnonzero(allele_counts == allele_count)
+            counts = np.zeros((len(group), allele_count))
+            counts[:, :len(SNV_BASES)] = snv_matrix[group]
+            if allele_count > len(SNV_BASES):
+                for group_row, row in enumerate(group.tolist()):
+                    counts[group_row, len(SNV_BASES):] = [count for _, count in indel_alleles[row]]
+
+            log_likelihoods = self.__genotype_log_likelihoods__(counts, correct_probability[group])
+            group_rows = np.arange(len(group))
+            group_best = log_likelihoods.argmax(axis=1)
+            best[group] = group_best
+            confidences[group] = 1 / np.exp(log_likelihoods - log_likelihoods[group_rows, group_best][:, None]).sum(axis=1)
+            ref_gl[group] = log_likelihoods[group_rows, ref_genotypes[group]] / np.log(10)
+            if genotype_likelihoods:
+                variant_rows = np.flatnonzero(group_best != ref_genotypes[group]).tolist()
+                for group_row in variant_rows:
+                    row_log_likelihoods[int(group[group_row])] = log_likelihoods[group_row].tolist()
+
+        # Homozygous reference calls (and positions without reads) need no allele bookkeeping
+        covered = snv_matrix.any(axis=1) | (allele_counts > len(SNV_BASES))
+        homozygous_reference = ((best == ref_genotypes) & (ref_columns >= 0)) | ~covered
+        confidences[~covered] = 1
+        ref_gl = (ref_gl.round(2) + 0.0).tolist()
+        first, second = self.__genotype_indices__(int(allele_counts.max()))
+
+        # Plain lists are much faster than numpy arrays to index one element at a time
+        homozygous_reference = homozygous_reference.tolist()
+        confidences = confidences.tolist()
+        ref_columns = ref_columns.tolist()
+        best = best.tolist()
+        first = first.tolist()
+        second = second.tolist()
+        for row, genomePositionInfo in enumerate(genome_position_infos):
+            if homozygous_reference[row]:
+                genomePositionInfo['vaf'] = confidences[row]
+                genomePositionInfo['genotype'] = (0, 0)
+                genomePositionInfo['alts'] = '.'
+                if genotype_likelihoods and ref_columns[row] >= 0:
+                    genomePositionInfo['gl'] = [ref_gl[row]]
+                    genomePositionInfo['pl'] = [0]
+                continue
+
+            position_alleles = [((base, 'SNV'), count) for base, count in zip(SNV_BASES, snv_counts[row])] + \
+                               [(indel_table.allele(indel_id), count) for indel_id, count in indel_alleles[row]]
+            first_allele, first_count = position_alleles[first[best[row]]]
+            second_allele, second_count = position_alleles[second[best[row]]]
+            if first_allele == second_allele:
+                most_probable_variant = [first_allele]
+            elif second_count > first_count:
+                most_probable_variant = [second_allele, first_allele]
+            else:
+                most_probable_variant = [first_allele, second_allele]
+
+            if genotype_likelihoods:
+                self.__store_genotype_likelihoods__(genomePositionInfo, position_alleles, most_probable_variant,
+                                                    row_log_likelihoods[row])
+            self.__store_called_variants__(genomePositionInfo, most_probable_variant, confidences[row])
+
+    def call_variant(self, genomePositionInfo, correct_probability = 0.8, use_read_quality = False,
+                     genotype_likelihoods = False, indel_table = INDEL_TABLE):
         """ Chooses variant and updates genomePositionInfo dictionary with chosen variant genotype, alts field, more
 
         Parameters
@@ -59,38 +224,57 @@ class VariantCaller(object):
             Probability that one nucleotide in a read is correct
         use_read_quality: bool
             Whether to use correct_probability estimate calculated using read qualities
+        genotype_likelihoods: bool
+            Whether to also store GL and PL values for the called alleles
+        indel_table: IndelTable
+            Table the indel ids of the positions belong to
         """
-        if use_read_quality:
-            correct_probability = genomePositionInfo['average_quality']
-        variant_count = { (base, 'SNV'): genomePositionInfo[base] for base in {'A', 'G', 'C', 'T'} }
-        
-        # Treat insertions and deletitions the same as SNVs
-        if 'insertions' in genomePositionInfo:
-            for insertion_string, insertion_count in genomePositionInfo['insertions']:
-                variant_count[(insertion_string, 'INS')] = insertion_count
-        if 'deletitions' in genomePositionInfo:
-            for deletition_string, deletition_count in genomePositionInfo['deletitions']:
-                variant_count[(deletition_string, 'DEL')] = deletition_count
-        
-        # Only keep two most likely bases
-        
-        candidate_variants = sorted(variant_count, key=variant_count.get, reverse=True)[:2]
-        candidate_variant_count = [(variant, variant_count[variant]) for variant in candidate_variants]
+        self.call_variants([genomePositionInfo], correct_probability, use_read_quality, genotype_likelihoods,
+                           indel_table)
 
-        # Check if no candidate variant exists:
-        if candidate_variant_count[0][1] == 0:
-            genomePositionInfo['vaf'] = 1
-            genomePositionInfo['genotype'] = (0, 0)
-            genomePositionInfo['alts'] = '.'
+    def __store_genotype_likelihoods__(self, genomePositionInfo, position_alleles, most_probable_variant,
+                                       log_likelihoods):
+        """ Stores GL (log10 likelihoods) and PL (phred scaled, normalized) of every
+        genotype over the reference and called alt alleles, in VCF genotype order
+
+        Parameters
+        ----------
+        genomePositionInfo: dictionary
+            All info about one pileup position
+        position_alleles: List of ((str, str), int) tuples
+            All alleles at the position and their counts
+        most_probable_variant: List of (str, str) tuples
+            Called alleles
+        log_likelihoods: list of float
+            Natural log likelihoods of all genotypes at the position
+        """
+        allele_index = {allele: index for index, (allele, _) in enumerate(position_alleles)}
+        ref_allele = (genomePositionInfo['ref_base'], 'SNV')
+        if ref_allele not in allele_index:
             return
+        vcf_alleles = [allele_index[ref_allele]] + [allele_index[variant] for variant in most_probable_variant
+                                                   if variant[0] != genomePositionInfo['ref_base']]
+        gl = []
+        for second_position, second_allele in enumerate(vcf_alleles):
+            for first_allele in vcf_alleles[:second_position + 1]:
+                low, high = min(first_allele, second_allele), max(first_allele, second_allele)
+                gl.append(log_likelihoods[high * (high + 1) // 2 + low] / math.log(10))
+        max_gl = max(gl)
+        genomePositionInfo['gl'] = [round(value, 2) + 0.0 for value in gl]
+        genomePositionInfo['pl'] = [int(round(-10 * (value - max_gl))) for value in gl]
 
-        # Check if only one option exists and skip calculations
-        if candidate_variant_count[1][1] == 0:
-            most_probable_variant = [candidate_variant_count[0][0]]
-            confidence = 1
-        else:
-            most_probable_variant, confidence = self.__calculate_most_probable_variant__(candidate_variant_count, correct_probability)
+    def __store_called_variants__(self, genomePositionInfo, most_probable_variant, confidence):
+        """ Stores called variants in genomePositionInfo, as genotype, alts and ref_base fields
 
+        Parameters
+        ----------
+        genomePositionInfo: dictionary
+            All info about one pileup position
+        most_probable_variant: List of (str, str) tuples
+            Called alleles, as (allele string, variant type)
+        confidence: float
+            Estimated correctness probability
+        """
         ref_variant_present = len([variant[0] for variant in most_probable_variant if (variant[0] == genomePositionInfo['ref_base'] and variant[1] == 'SNV')]) > 0
 
         alt_variants = [variant[0] for variant in most_probable_variant if variant[0] != genomePositionInfo['ref_base']]
@@ -1,32 +1,59 @@
-import pysam
 import datetime
+import gzip
+import heapq
+import struct
 
-def create_vcf_file(path, sample):
-    """ Creates VCF header and Variant File. 
-    Writes VCF header in Variant File and returns it. 
+FAI_PATH = "test_data/human_g1k_v37_decoy.fasta.fai"
+
+def default_sample_names(sample_count):
+    """ Returns names of samples in a VCF file: SAMPLE1, SAMPLE2, ...
+    
+    Parameters
+    ----------
+    sample_count: int
+        Number of samples
+    
+    Returns
+    -------
+    str or list of str
+        Name of the only sample, or list of names if there is more than one
+    """
+    
+    if sample_count == 1:
+        return 'SAMPLE1'
+    return ['SAMPLE{}'.format(i + 1) for i in range(sample_count)]
+
+def create_vcf_header(sample, genotype_likelihoods=False, fai_path=FAI_PATH):
+    """ Creates VCF header with contigs from the reference .fai file. 
         
     Parameters
     ----------
-    path: str
-        Name and path of an output vcf file, for example output/out.vcf
-    sample: str
-        Name of a sample to add to the VCF file
+    sample: str or list of str
+        Name of a sample, or names of samples to add to the VCF file
+    genotype_likelihoods: bool
+        Whether to declare GL and PL format fields in the header
+    fai_path: str
+        Path to the .fai index of the reference genome
     
     Returns
     -------
-    pysam.VariantFile
-        Created VCF file with header written in it
+    pysam.VariantHeader
+        Created VCF header
     """
     
+    # pysam is only needed once we actually write, so it is imported lazily
+    import pysam
+    
     vcf_header = pysam.VariantHeader()
-    vcf_header.add_sample(sample)
+    for sample_name in ([sample] if isinstance(sample, str) else sample):
+        vcf_header.add_sample(sample_name)
     
     current_time = datetime.datetime.now()
     date = current_time.strftime('%Y%m%d')
     vcf_header.add_line('##fileDate=' + date)
     vcf_header.add_line('##source=Ema&Nikola')                    
     
-    faifile = open("test_data/human_g1k_v37_decoy.fasta.fai")
+    faifile = open(fai_path)
     for line in faifile:
             split_line = line.split("\t")
             contig = '##contig=<ID=' + str(split_line[0]) + ', length=' + str(split_line[1]) + '>'
@@ -35,10 +62,115 @@ def create_vcf_file(path, sample):
     vcf_header.add_line("##ALT=<ID=*,Description=Different allele than referent.>")
     vcf_header.add_line("##FORMAT=<ID=GT,Number=1,Type=String,Description=Genotype>")
     vcf_header.add_line("##FORMAT=<ID=VAF,Number=1,Type=String,Description=Variant allele frequency>")
- 
+    if genotype_likelihoods:
+        vcf_header.add_line("##FORMAT=<ID=GL,Number=G,Type=Float,Description=Genotype likelihoods>")
+        vcf_header.add_line("##FORMAT=<ID=PL,Number=G,Type=Integer,Description=Phred-scaled genotype likelihoods>")
+    return vcf_header
+
+def create_vcf_file(path, sample, genotype_likelihoods=False):
+    """ Creates VCF header and Variant File. 
+    Writes VCF header in Variant File and returns it. 
+        
+    Parameters
+    ----------
+    path: str
+        Name and path of an output vcf file, for example output/out.vcf
+    sample: str or list of str
+        Name of a sample, or names of samples to add to the VCF file
+    genotype_likelihoods: bool
+        Whether to declare GL and PL format fields in the header
+    
+    Returns
+    -------
+    pysam.VariantFile
+        Created VCF file with header written in it
+    """
+    
+    import pysam
+    
+    vcf_header = create_vcf_header(sample, genotype_likelihoods)
     vcf = pysam.VariantFile(path, 'w', header = vcf_header)
     return vcf
 
+def set_sample_fields(record, sample, sample_record, allele_indices):
+    """ Writes genotype, VAF and optionally GL and PL of one sample to a VCF
+    record, translating the sample's own alleles to the record's alleles.
+    
+    Parameters
+    ----------
+    record: pysam.VariantRecord
+        VCF record to write to
+    sample: str
+        Name of the sample in the VCF file
+    sample_record: dict
+        Called pileup line, or called sample of a multi-sample pileup line
+    allele_indices: list of int
+        Index in the record's alleles of the sample's reference and alts
+    """
+    
+    genotype = tuple(sorted(allele_indices[allele] for allele in sample_record['genotype']))
+    record.samples[sample]['GT'] = genotype
+    record.samples[sample]['VAF'] = str(sample_record['vaf'])
+    if 'gl' in sample_record:
+        # GL and PL of genotypes with alleles the sample was not called over are missing
+        genotype_index = {}
+        for second in range(len(allele_indices)):
+            for first in range(second + 1):
+                low, high = sorted((allele_indices[first], allele_indices[second]))
+                genotype_index[(low, high)] = second * (second + 1) // 2 + first
+        genotypes = [genotype_index.get((low, high)) for high in range(len(record.alleles)) for low in range(high + 1)]
+        record.samples[sample]['GL'] = [None if i is None else sample_record['gl'][i] for i in genotypes]
+        record.samples[sample]['PL'] = [None if i is None else sample_record['pl'][i] for i in genotypes]
+
+def create_vcf_record(pileup_record, vcf_header, sample): 
+    """ Creates a VCF record from a pileup record for a given sample. 
+    Multi-sample pileup records get one record for all samples, with
+    alleles of every sample normalized to the longest reference.
+    
+    Parameters
+    ----------
+    pileup_record: dict
+        Called pileup line to be converted to a VCF record
+    vcf_header: pysam.VariantHeader
+        Header of the VCF file the record belongs to
+    sample: str or list of str
+        Name of a sample, or names of samples in the VCF file
+    
+    Returns
+    -------
+    pysam.VariantRecord
+        Created VCF record
+    """
+    
+    sample_records = pileup_record.get('samples', [pileup_record])
+    samples = [sample] if isinstance(sample, str) else sample
+    
+    # Deletitions make the reference longer, so the shorter references and
+    # their alts get the rest of the longest reference appended
+    ref = max((sample_record['ref_base'] for sample_record in sample_records), key=len)
+    alleles = [ref]
+    sample_allele_indices = []
+    for sample_record in sample_records:
+        suffix = ref[len(sample_record['ref_base']):]
+        sample_alleles = [sample_record['ref_base']]
+        if sample_record['alts'] != '.':
+            sample_alleles += sample_record['alts']
+        allele_indices = []
+        for allele in sample_alleles:
+            if allele + suffix not in alleles:
+                alleles.append(allele + suffix)
+            allele_indices.append(alleles.index(allele + suffix))
+        sample_allele_indices.append(allele_indices)
+    
+    record = vcf_header.new_record()
+    record.contig = pileup_record['chromosome']
+    record.pos = pileup_record['position']
+    record.ref = ref
+    record.alts = alleles[1:] if len(alleles) > 1 else '.'
+    for sample_name, sample_record, allele_indices in zip(samples, sample_records, sample_allele_indices):
+        set_sample_fields(record, sample_name, sample_record, allele_indices)
+    return record
+
 def write_vcf_line(pileup_record, vcf, sample): 
     """ Writes a line from a pileup record for a given sample to given vcf file.
     
@@ -48,20 +180,208 @@ def write_vcf_line(pileup_record, vcf, sample):
         Line of a pileup file to be written to VCF
     vcf: pysam.VariantFile
         VCF file where to write
-    sample: str
-        Name of a sample in the VCF file
+    sample: str or list of str
+        Name of a sample, or names of samples in the VCF file
     
     """
     
-    record = vcf.header.new_record()
-    record.contig = pileup_record['chromosome']
-    record.pos = pileup_record['position']
-    record.ref = pileup_record['ref_base']
-    record.alts = pileup_record['alts']
-    record.samples[sample]['GT'] = pileup_record['genotype']
-    record.samples[sample]['VAF'] = str(pileup_record['vaf'])
+    vcf.write(create_vcf_record(pileup_record, vcf.header, sample))
+
+def reg2bin(beg, end):
+    """ Returns the smallest bin of the UCSC binning scheme containing a
+    0-based, end exclusive interval, as used by tabix.
+    
+    Parameters
+    ----------
+    beg: int
+        Start of the interval
+    end: int
+        End of the interval
+    
+    Returns
+    -------
+    int
+        Bin number
+    """
+    
+    end -= 1
+    if beg >> 14 == end >> 14:
+        return ((1 << 15) - 1) // 7 + (beg >> 14)
+    if beg >> 17 == end >> 17:
+        return ((1 << 12) - 1) // 7 + (beg >> 17)
+    if beg >> 20 == end >> 20:
+        return ((1 << 9) - 1) // 7 + (beg >> 20)
+    if beg >> 23 == end >> 23:
+        return ((1 << 6) - 1) // 7 + (beg >> 23)
+    if beg >> 26 == end >> 26:
+        return ((1 << 3) - 1) // 7 + (beg >> 26)
+    return 0
+
+class TabixIndexBuilder(object):
+    """ Builds a tabix (.tbi) index of a BGZF compressed VCF file from the
+    virtual offsets of its records, while the file is being written.
+    """
+    
+    # Pseudo-bin holding offsets and record counts of a whole contig
+    META_BIN = 37450
+    
+    def __init__(self):
+        self.contigs = []
+        self.references = {}
+    
+    def add(self, contig, beg, end, start_offset, end_offset):
+        """ Adds a record to the index
+        
+        Parameters
+        ----------
+        contig: str
+            Contig of the record
+        beg: int
+            0-based start of the record
+        end: int
+            0-based, exclusive end of the record
+        start_offset: int
+            Virtual offset of the start of the record in the BGZF file
+        end_offset: int
+            Virtual offset of the end of the record in the BGZF file
+        """
+        if contig not in self.references:
+            self.contigs.append(contig)
+            self.references[contig] = {'bins': {}, 'linear': [], 'start': start_offset, 'records': 0}
+        reference = self.references[contig]
+        reference['end'] = end_offset
+        reference['records'] += 1
+        
+        chunks = reference['bins'].setdefault(reg2bin(beg, end), [])
+        if chunks and chunks[-1][1] == start_offset:
+            chunks[-1][1] = end_offset
+        else:
+            chunks.append([start_offset, end_offset])
+        
+        linear = reference['linear']
+        last_window = (end - 1) >> 14
+        if len(linear) <= last_window:
+            linear.extend([None] * (last_window + 1 - len(linear)))
+        for window in range(beg >> 14, last_window + 1):
+            if linear[window] is None:
+                linear[window] = start_offset
+    
+    def write(self, path):
+        """ Writes the index, BGZF compressed, to a file
+        
+        Parameters
+        ----------
+        path: str
+            Path to the index file, usually path of the VCF file + .tbi
+        """
+        import pysam
+        
+        names = b''.join(contig.encode() + b'\0' for contig in self.contigs)
+        # format 2 is VCF: contig in column 1, position in column 2, '#' starts header lines
+        data = [b'TBI\1', struct.pack('<8i', len(self.contigs), 2, 1, 2, 0, ord('#'), 0, len(names)), names]
+        for contig in self.contigs:
+            reference = self.references[contig]
+            data.append(struct.pack('<i', len(reference['bins']) + 1))
+            for bin_number, chunks in reference['bins'].items():
+                data.append(struct.pack('<Ii', bin_number, len(chunks)))
+                data.extend(struct.pack('<QQ', *chunk) for chunk in chunks)
+            data.append(struct.pack('<Ii', self.META_BIN, 2))
+            data.append(struct.pack('<QQQQ', reference['start'], reference['end'], reference['records'], 0))
+            
+            # Windows without records start where the next record after them does
+            linear = reference['linear']
+            for window in range(len(linear) - 2, -1, -1):
+                if linear[window] is None:
+                    linear[window] = linear[window + 1]
+            data.append(struct.pack('<i', len(linear)))
+            data.append(struct.pack('<{}Q'.format(len(linear)), *linear))
+        
+        index_file = pysam.BGZFile(path, 'wb')
+        index_file.write(b''.join(data))
+        index_file.close()
+
+def read_vcf_shard(path):
+    """ Reads a VCF shard, plain or compressed, splitting header lines from
+    records.
+    
+    Parameters
+    ----------
+    path: str
+        Path to the VCF shard
+    
+    Returns
+    -------
+    (list of str, iterator of str)
+        Header lines and an iterator over record lines
+    """
+    
+    shard = gzip.open(path, 'rt') if path.endswith('.gz') else open(path, 'r')
+    header = []
+    for line in shard:
+        if not line.startswith('#'):
+            def records(first_line=line):
+                yield first_line
+                yield from shard
+                shard.close()
+            return header, records()
+        header.append(line)
+    shard.close()
+    return header, iter(())
+
+def merge_vcf_shards(shard_paths, path, fai_path=FAI_PATH):
+    """ Merges position sorted VCF shards into one BGZF compressed VCF file,
+    in the contig order of the reference .fai file, and builds its tabix
+    index while writing it. Header is taken from the first shard.
+    
+    Parameters
+    ----------
+    shard_paths: list of str
+        Paths to the VCF shards, plain or compressed
+    path: str
+        Path to the merged VCF file, for example output/out.vcf.gz. The
+        index is written next to it, with .tbi appended
+    fai_path: str
+        Path to the .fai index of the reference genome
+    
+    Returns
+    -------
+    int
+        Number of merged records
+    """
+    
+    import pysam
+    
+    with open(fai_path) as faifile:
+        contig_order = {line.split('\t')[0]: rank for rank, line in enumerate(faifile)}
+    
+    def sort_key(line):
+        contig, position = line.split('\t', 2)[:2]
+        return contig_order.get(contig, len(contig_order)), contig, int(position)
+    
+    header = None
+    shards = []
+    for shard_path in shard_paths:
+        shard_header, records = read_vcf_shard(shard_path)
+        if header is None:
+            header = shard_header
+        shards.append(records)
     
-    vcf.write(record)
+    index = TabixIndexBuilder()
+    vcf = pysam.BGZFile(path, 'wb')
+    vcf.write(''.join(header or []).encode())
+    record_count = 0
+    for line in heapq.merge(*shards, key=sort_key):
+        if not line.endswith('\n'):
+            line += '\n'
+        contig, position, _, ref = line.split('\t', 4)[:4]
+        beg = int(position) - 1
+        start_offset = vcf.tell()
+        vcf.write(line.encode())
+        index.add(contig, beg, beg + len(ref), start_offset, vcf.tell())
+        record_count += 1
+    vcf.close()
+    index.write(path + '.tbi')
+    return record_count
 
 if __name__ == '__main__':
     sample = 'SAMPLE1'